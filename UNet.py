@@ -44,7 +44,7 @@ def UNet(feature_channels, image_size, input_channels=1):
     ups_3 = up_block(ups_2, conv_2, feature_maps[1]) #128 -> 256
     ups_4 = up_block(ups_3, conv_1, feature_maps[0]) #256 -> 512
 
-    outputs = tf.keras.layers.Conv2D(1, (1,1), padding='same', activation='sigmoid')(ups_4)
+    outputs = tf.keras.layers.Conv2D(1, (1,1), padding='same', activation='sigmoid', dtype='float32')(ups_4) #Output kept in float32 for mixed precision
 
     model = tf.keras.models.Model(inputs, outputs)
     return model
@@ -31,7 +31,7 @@ def predict(
     image = image / 255
     print(image.shape)
 
-    trainer = Trainer(preprocessing_params=preprocessings) 
+    trainer = Trainer(preprocessing_params=preprocessings, precision_policy='float32') 
     trainer.build_model()
     trainer.model.load_weights(model_path)
     result = trainer.model.predict(image)
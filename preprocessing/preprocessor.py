@@ -98,9 +98,9 @@ class Preprocessor:
     def get_processed_np_img(self, normalized: bool=True) -> np.array:
         '''Obtain Image as a numpy array'''
         if normalized:
-            return np.asarray(self.img.getdata()).reshape(self.img.size[1], self.img.size[0], -1) /255
+            return np.asarray(self.img).reshape(self.img.size[1], self.img.size[0], -1) /255
         else:
-            return np.asarray(self.img.getdata()).reshape(self.img.size[1], self.img.size[0], -1) 
+            return np.asarray(self.img).reshape(self.img.size[1], self.img.size[0], -1) 
 
     def save(self, name: str, path: str="./src/data/temp/") -> None:
         '''Save Image to path'''
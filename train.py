@@ -1,21 +1,18 @@
 import numpy as np
 import tensorflow as tf 
-from tensorflow.keras.preprocessing.image import ImageDataGenerator 
-from sklearn.metrics import jaccard_score, confusion_matrix
-import cv2
 import mlflow
 import sys, os, datetime, time
 from typing import Dict, Tuple
 import random
 #Imports from solution
 from UNet import UNet
-from preprocessing import preprocessing_opencv as prep
 import utils
 
 #PARAMETERS
 params = {
     'shuffle': True,
-    'seed': 1
+    'seed': 1,
+    'deterministic': True
 }
 
 #SEEDS
@@ -28,6 +25,9 @@ tf.random.set_seed(params['seed'])
 class Trainer:
     '''Tensorflow model trainer.'''
 
+    #Augumentation parameters scaled by augumentation_factor
+    _NUMERIC_AUG_KEYS = {'rotation_range', 'zoom_range', 'width_shift_range', 'height_shift_range', 'cval'}
+
     def __init__(self, debug_mode = False, 
         epochs=140, 
         batch_size=8,
@@ -36,6 +36,7 @@ class Trainer:
         data_directory='npy_datasets/cv_data/', 
         log_directory= 'logs/fit/',
         model_directory='src/models/',
+        precision_policy='mixed_float16',
         preprocessing_params={}, 
         augumentation_parameters={}
         ) -> None:
@@ -53,6 +54,7 @@ class Trainer:
         self.log_dir = log_directory + datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
         self.model_dir = model_directory
         self.data_dir = data_directory
+        self.precision_policy = tf.keras.mixed_precision.Policy(precision_policy)
 
         #Parameters
         self.augument = {
@@ -62,18 +64,6 @@ class Trainer:
             'height_shift_range': 0.1,
             'fill_mode': 'constant',
             'cval': 0.0,
-            'shear_range': 0.2,
-            'horizontal_flip':True,
-            'vertical_flip': True
-        }
-        self.augument_mask = {
-            'rotation_range': 30,
-            'zoom_range': 0.1,
-            'width_shift_range': 0.1,
-            'height_shift_range': 0.1,
-            'fill_mode': 'constant',
-            'cval': 0.0,
-            'shear_range': 0.2,
             'horizontal_flip':True,
             'vertical_flip': True
         }
@@ -99,15 +89,12 @@ class Trainer:
 
         for key, value in augumentation_parameters.items():
             self.augument[key] = value
-            self.augument_mask[key] = value
      
         #Check for multiplicable parameters
         aug_factor = self.preprocessing_parameters['augumentation_factor'] 
         if aug_factor != 1:     
-            for key in self.augument.keys():
-                if str(self.augument[key]).replace('.','',1).isdigit():
-                    self.augument[key] *= aug_factor 
-                    self.augument_mask[key] *= aug_factor
+            for key in self._NUMERIC_AUG_KEYS & self.augument.keys():
+                self.augument[key] *= aug_factor 
  
         print(f'Augumentation parameters: {self.augument}')
 
@@ -151,15 +138,16 @@ class Trainer:
         mlflow.end_run()
 
     def __load_data_into_dict(self) -> None:
-        '''Fetch data from numpy tables and create dictionary with train, val, test data'''
+        '''Memory-map numpy tables and create dictionary with train, val, test data. 
+        Samples are read from disk only when the data pipelines need them.'''
         dir = self.data_dir
         self.data = {}
-        self.data['train_images'] =  np.load(dir + 'cv_train_images.npy')
-        self.data['train_masks'] = np.load(dir + 'cv_train_masks.npy')
-        self.data['val_images'] =  np.load(dir + 'cv_val_images.npy')
-        self.data['val_masks'] =  np.load(dir + 'cv_val_masks.npy')
-        self.data['test_images'] =  np.load(dir + 'cv_test_images.npy')
-        self.data['test_masks'] =  np.load(dir + 'cv_test_masks.npy')
+        self.data['train_images'] =  np.load(dir + 'cv_train_images.npy', mmap_mode='r')
+        self.data['train_masks'] = np.load(dir + 'cv_train_masks.npy', mmap_mode='r')
+        self.data['val_images'] =  np.load(dir + 'cv_val_images.npy', mmap_mode='r')
+        self.data['val_masks'] =  np.load(dir + 'cv_val_masks.npy', mmap_mode='r')
+        self.data['test_images'] =  np.load(dir + 'cv_test_images.npy', mmap_mode='r')
+        self.data['test_masks'] =  np.load(dir + 'cv_test_masks.npy', mmap_mode='r')
 
         if self.mlflow:
             mlflow.log_param('Training set shape', self.data['train_images'].shape)
@@ -172,68 +160,131 @@ class Trainer:
         print('Validation set shape', self.data['val_images'].shape)
         print('Test set shape', self.data['test_images'].shape)
 
+    def __fused_datasets(self, steps, image_dtype, mask_dtype, image_shape, splits=('train', 'val', 'test')) -> Dict[str, tf.data.Dataset]:
+        '''Create datasets with all numpy preprocessing steps fused into a single parallel map transformation.\n
+        Return: `datasets` dictionary with split names as keys'''
+        steps = list(steps)
+
+        def preprocess(images, masks):
+            for step in steps:
+                images, masks = step(images, masks)
+            return images, masks
+
+        map_fn = utils.numpy_map(preprocess, image_dtype, mask_dtype, image_shape)
+        datasets = {}
+        for split in splits:
+            datasets[split] = utils.dataset_from_arrays(self.data[f'{split}_images'], self.data[f'{split}_masks'])
+            if steps:
+                datasets[split] = datasets[split].map(map_fn, num_parallel_calls=tf.data.AUTOTUNE)
+        return datasets
+
     def __apply_preprocessings(self) -> None:
-        '''Apply preprocessings based on parameters contained in preprocessing_parameters dictionary'''
+        '''Create train/val/test datasets and add preprocessings based on parameters contained in preprocessing_parameters dictionary.
+        Preprocessings are fused into a single pass over each sample and preprocessed samples are cached, so preprocessings are executed only once.'''
+        steps = []
+        image_dtype = tf.as_dtype(self.data['train_images'].dtype)
+        mask_dtype = tf.as_dtype(self.data['train_masks'].dtype)
+        image_shape = self.data['train_images'].shape[1:]
+
         #APPLY GAUSSIAN BLUR - performed on train/val/test input images
         if self.preprocessing_parameters['gaussian_blur']:
-            for key in self.data.keys():
-                if 'images' in key:
-                    self.data[key] = utils.apply_gaussian_blur(self.data[key], self.preprocessing_parameters['gaussian_blur_radius'])
+            radius = self.preprocessing_parameters['gaussian_blur_radius']
+            steps.append(lambda images, masks: (utils.apply_gaussian_blur(images, radius), masks))
             print('Applied gaussian blur on all input images')
 
         #APPLY HISTOGRAM EQUALIZATION - performed on train/val/test input images
         if self.preprocessing_parameters['histogram_equalization']:
-            for key in self.data.keys():
-                if 'images' in key:
-                    self.data[key] = utils.apply_histogram_equalization(self.data[key], self.preprocessing_parameters['histogram_cutoff_percentage'])
+            cutoff = self.preprocessing_parameters['histogram_cutoff_percentage']
+            steps.append(lambda images, masks: (utils.apply_histogram_equalization(images, cutoff), masks))
             print('Applied histogram equalization on all input images')
 
         #GET CONNECTED COMPONENTS
         if self.preprocessing_parameters['connected_components']:
-            for key in self.data.keys():
-                if 'images' in key:
-                    self.data[key] = prep.connected_components_on_batch(np.array(self.data[key], dtype='f'), take=5)
-            self.input_shape = self.data['train_images'].shape
+            take = 5
+            steps.append(lambda images, masks: (utils.add_connected_components(images, take), masks))
+            image_dtype = tf.float32
+            image_shape = (*image_shape[:-1], image_shape[-1] + take)
+            self.input_shape = image_shape
             print('Applied and added connected components channels')
 
         #APPLY NORMALIZATION PER-CHANNEL
-        if self.preprocessing_parameters['per_channel_normalization']:      
-            self.data['train_images'] , mean = utils.norm_per_channel(self.data['train_images'] )
-            self.data['val_images'], mean = utils.norm_per_channel(self.data['val_images'], mean)
-            self.data['test_images'], mean = utils.norm_per_channel(self.data['test_images'], mean)
+        if self.preprocessing_parameters['per_channel_normalization']:
+            train_dataset = self.__fused_datasets(steps, image_dtype, mask_dtype, image_shape, splits=['train'])['train']
+            total, count = train_dataset.map(lambda image, mask: image).reduce(
+                (tf.constant(0, tf.float64), tf.constant(0, tf.float64)),
+                lambda state, image: (state[0] + tf.reduce_sum(tf.cast(image, tf.float64)), state[1] + tf.cast(tf.size(image), tf.float64))
+                )
+            mean = float(total / count)
+            steps.append(lambda images, masks: (utils.norm_per_channel(images, mean)[0], masks))
+            image_dtype = tf.float32
             mlflow.log_param('mean_per_channel', mean)
-            print('Normalized per channel')
+            print(f'Normalized per channel, training channel mean: {mean}')
 
         #APPLY NORMALIZATION
         if self.preprocessing_parameters['normalization']:
-            self.data['train_images'], self.data['train_masks'] = utils.normalize(self.data['train_images'], self.data['train_masks'])
-            self.data['test_images'], self.data['test_masks'] = utils.normalize(self.data['test_images'], self.data['test_masks'])
-            self.data['val_images'], self.data['val_masks'] = utils.normalize(self.data['val_images'], self.data['val_masks'])
+            steps.append(utils.normalize)
+            image_dtype = mask_dtype = tf.float32
             print('Applied normalization')
 
+        self.datasets = self.__fused_datasets(steps, image_dtype, mask_dtype, image_shape)
+
         #APPLY ZCA
         if self.preprocessing_parameters['zca_whitening']:
-            gen = ImageDataGenerator(featurewise_center=True ,zca_whitening=True)
             print('ZCA fit will be performed, it might take some time')
-            gen.fit(self.data['train_images'][0:250], seed=133)
+            fit_images = np.stack([image for image, _ in self.datasets['train'].take(250).as_numpy_iterator()])
+            mean, components = utils.fit_zca(fit_images)
+            components = tf.constant(components, dtype=tf.float32)
             print('ZCA fit done')
-            
-
-            for i in range(len(self.data['train_images'])):
-                self.data['train_images'][i] = gen.standardize(self.data['train_images'][i])
 
-                if i < len(self.data['val_images']):
-                    self.data['val_images'][i] = gen.standardize(self.data['val_images'][i])
-                if i < len(self.data['test_images']):
-                    self.data['test_images'][i] = gen.standardize(self.data['test_images'][i])
-
-                if i % 50 == 0:
-                    print('ZCA applied to ', i, ' samples')
+            #Whitening is applied on batches, so it is a single matmul instead of one per sample
+            def zca(images, masks):
+                flat = tf.reshape(tf.cast(images, tf.float32) - mean, (tf.shape(images)[0], -1))
+                return tf.reshape(tf.matmul(flat, components), tf.shape(images)), masks
 
+            for split in self.datasets.keys():
+                self.datasets[split] = self.datasets[split].batch(self.batch_size).map(zca, num_parallel_calls=tf.data.AUTOTUNE).unbatch()
             print('Applied zca_whitening')
 
+        for split in self.datasets.keys():
+            self.datasets[split] = self.datasets[split].cache()
+
+    def __build_augmentation(self) -> tf.keras.Sequential:
+        '''Build random transformation layers based on augumentation parameters.
+        Flips are applied separately in `__augment`, shear is not supported.'''
+        aug = self.augument
+        if aug.get('shear_range'):
+            print(f'Warning: shear_range={aug["shear_range"]} is not supported and will not be applied')
+        fill = {'fill_mode': aug.get('fill_mode', 'constant'), 'fill_value': aug.get('cval', 0.0)}
+
+        layers = []
+        if aug.get('rotation_range'):
+            layers.append(tf.keras.layers.RandomRotation(aug['rotation_range'] / 360, **fill))
+        if aug.get('zoom_range'):
+            layers.append(tf.keras.layers.RandomZoom(aug['zoom_range'], aug['zoom_range'], **fill))
+        if aug.get('width_shift_range') or aug.get('height_shift_range'):
+            layers.append(tf.keras.layers.RandomTranslation(aug.get('height_shift_range', 0), aug.get('width_shift_range', 0), **fill))
+
+        return tf.keras.Sequential(layers)
+
+    def __augment(self, images, masks) -> Tuple[tf.Tensor, tf.Tensor]:
+        '''Apply identical random transformations to a batch of images and masks.
+        Images and masks are stacked along channel axis and split after transformations.'''
+        images = tf.cast(images, tf.float32)
+        masks = tf.cast(masks, tf.float32)
+        channels = tf.shape(images)[-1]
+
+        stacked = tf.concat([images, masks], axis=-1)
+        if self.augument.get('horizontal_flip'):
+            stacked = tf.image.random_flip_left_right(stacked)
+        if self.augument.get('vertical_flip'):
+            stacked = tf.image.random_flip_up_down(stacked)
+        if self.augmentation.layers:
+            stacked = self.augmentation(stacked, training=True)
+
+        return tf.cast(stacked[..., :channels], self.precision_policy.compute_dtype), stacked[..., channels:]
+
     def load_data(self) -> None:
-        '''Load data, create generators and apply preprocessing according to parameters.'''
+        '''Load data, create pipelines and apply preprocessing according to parameters.'''
         with tf.device('/device:GPU:0'):
 
             #Fetch data from file and create dictionary
@@ -246,60 +297,67 @@ class Trainer:
             #Disable data augumentation
             if not self.preprocessing_parameters['augumentation']:
                 self.augument = {}
-                self.augument_mask ={}
                 print('Data augumentation off')
             else:
                 print('Data augumentation on')
 
-            #Initialize generators
-            datagen = ImageDataGenerator(**self.augument)
-            datagen.fit(self.data['train_images'], seed=params['seed'])
-
-            maskdatagen = ImageDataGenerator(**self.augument_mask)
-            maskdatagen.fit(self.data['train_masks'],seed=params['seed'])
+            #Initialize tf.data pipelines, augumentation runs in parallel with training
+            self.augmentation = self.__build_augmentation()
 
-            validdatagen = ImageDataGenerator()
+            train_dataset = self.datasets['train']
+            if params['shuffle']:
+                train_dataset = train_dataset.shuffle(len(self.data['train_images']), seed=params['seed'], reshuffle_each_iteration=True)
+            train_dataset = train_dataset.batch(self.batch_size)
+            #Set params['deterministic'] to False to yield augumented batches out of order, so a slow batch does not block
+            #the following ones. It gives up reproducibility of seeded runs.
+            train_dataset = train_dataset.map(self.__augment, num_parallel_calls=tf.data.AUTOTUNE, deterministic=params['deterministic'])
+            train_dataset = train_dataset.prefetch(tf.data.AUTOTUNE)
 
-            #Initialize flow and zip it to format proper to fit() function 
-            image_iterator = datagen.flow(self.data['train_images'], batch_size=self.batch_size, shuffle=params['shuffle'], seed=params['seed'])
-            mask_iterator = maskdatagen.flow(self.data['train_masks'], batch_size=self.batch_size, shuffle=params['shuffle'], seed=params['seed'])
-            self.train_iterator = zip(image_iterator, mask_iterator)
-            self.train_steps = len(image_iterator)
+            valid_dataset = self.datasets['val'].batch(self.batch_size).prefetch(tf.data.AUTOTUNE)
 
-            valid_image_iterator = validdatagen.flow(self.data['val_images'], batch_size=self.batch_size, shuffle=params['shuffle'], seed=params['seed'])
-            valid_mask_iterator = validdatagen.flow(self.data['val_masks'], batch_size=self.batch_size, shuffle=params['shuffle'], seed=params['seed'])
-            self.valid_iterator = zip(valid_image_iterator, valid_mask_iterator)
-            self.valid_steps = len(valid_image_iterator)
+            #Copy next batches to GPU ahead of time, it has to be the last transformation
+            self.train_dataset = train_dataset.apply(tf.data.experimental.prefetch_to_device('/device:GPU:0', buffer_size=2))
+            self.valid_dataset = valid_dataset.apply(tf.data.experimental.prefetch_to_device('/device:GPU:0', buffer_size=2))
 
             print('Prep done')
-            print(f'Training samples: {len(self.data["train_images"])}, channel mean: {np.mean(self.data["train_images"])},\nValidation samples: {len(self.data["val_images"])}, channel mean: {np.mean(self.data["val_images"])}')
+            print(f'Training samples: {len(self.data["train_images"])},\nValidation samples: {len(self.data["val_images"])}')
+            if self.debug_mode:
+                print(f'Raw training channel mean: {np.mean(self.data["train_images"])}, raw validation channel mean: {np.mean(self.data["val_images"])}')
 
     def build_model(self) -> str:
         '''Build and compile tf model structure from custom UNet architecture.\n
         Return: model summary'''
         with tf.device('/device:GPU:0'):
-            self.model = UNet(self.feature_channels, self.image_size, self.input_shape[-1])  
+            #Precision policy is scoped to the model, so data pipelines and later trainers keep the default policy
+            previous_policy = tf.keras.mixed_precision.global_policy()
+            tf.keras.mixed_precision.set_global_policy(self.precision_policy)
+            try:
+                self.model = UNet(self.feature_channels, self.image_size, self.input_shape[-1])  
+            finally:
+                tf.keras.mixed_precision.set_global_policy(previous_policy)
             
+            optimizer = self.optimizer
+            if self.precision_policy.compute_dtype == 'float16':
+                optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+
             self.model.compile(
-                optimizer=self.optimizer, 
+                optimizer=optimizer, 
                 loss='binary_crossentropy', 
-                metrics=self.metrics
+                metrics=self.metrics,
+                jit_compile=True
                 )
             
             print('Model built.')
         return self.model.summary()
 
     def train(self) -> None:
-        '''Train model with fit() function.'''
-        with tf.device('/device:GPU:0'):
-            self.model.fit(
-                self.train_iterator,
-                steps_per_epoch=self.train_steps ,
-                epochs=self.epochs, 
-                validation_steps=self.valid_steps,
-                validation_data=self.valid_iterator,
-                callbacks=self.callbacks
-            )
+        '''Train model with fit() function. Device placement is handled by data pipelines.'''
+        self.model.fit(
+            self.train_dataset,
+            epochs=self.epochs, 
+            validation_data=self.valid_dataset,
+            callbacks=self.callbacks
+        )
 
     def save(self) -> str:   
         '''Save model weights into h5 format. \n
@@ -322,10 +380,8 @@ class Trainer:
     def evaluate(self) -> None:  
         '''Evaluate and save model performance with metrics'''
         res = self.model.evaluate(
-            x=self.data['test_images'], 
-            y=self.data['test_masks'], 
-            verbose=1, 
-            batch_size=self.batch_size
+            self.datasets['test'].batch(self.batch_size).prefetch(tf.data.AUTOTUNE), 
+            verbose=1
             )
 
         if self.mlflow:
@@ -335,36 +391,27 @@ class Trainer:
         '''Test model for additional metrics: 
         sensitivity, specifitivity, jaccard index, isic score, dice.\n
         Return: `test_accuracy, test_jaccard_score, test_precision, test_sensitivity, test_specifitivity`'''
-        results = self.model.predict(self.data['test_images'])
-
-        jacc_sum = tn = tp = fp = fn = test_jacc_sum = test_jacc_above_thresh= 0
-
-        for r,mask in zip(results, self.data['test_masks']):
-            
-            d = mask > 0.5
-            _, r = cv2.threshold( np.array(r*255, dtype='uint8'), 0, 255, cv2.THRESH_OTSU)
-            r = (r/255 ) > 0.5
-
-            r = r.flatten()
-            d = d.flatten()
-
-            inter = np.logical_and(d,r).sum()
-            union = np.logical_or(d,r).sum()
-
-            jacc_sum += inter / union 
-
-            #Additional metrics
-            tn_, fp_, fn_, tp_ = confusion_matrix(d, r).ravel()
-            tn += tn_ 
-            tp += tp_
-            fp += fp_
-            fn += fn_
-
-            test_jaccard_score = jaccard_score(d, r)
-            if test_jacc_sum >= 0.65:
-                test_jacc_above_thresh+=1
-
-            test_jacc_sum += test_jaccard_score
+        #Predictions are binarized with Otsu threshold of each image before leaving the device
+        binarized_model = tf.keras.Model(self.model.input, tf.keras.layers.Lambda(utils.otsu_binarize, dtype='float32')(self.model.output))
+        test_images = self.datasets['test'].map(lambda image, mask: image).batch(self.batch_size).prefetch(tf.data.AUTOTUNE)
+        results = binarized_model.predict(test_images, verbose=0)
+
+        #Whole batch is viewed as (N, H*W) boolean masks without copying
+        r = results.reshape(len(results), -1).view(bool)
+        d = (self.data['test_masks'] > 0.5).reshape(len(results), -1)
+
+        #Count tp, fp, fn, tn of each image with reductions along pixel axis
+        tp_ = np.count_nonzero(d & r, axis=1)
+        fp_ = np.count_nonzero(r, axis=1) - tp_
+        fn_ = np.count_nonzero(d, axis=1) - tp_
+        tn_ = d.shape[1] - tp_ - fp_ - fn_
+        tn, fp, fn, tp = tn_.sum(), fp_.sum(), fn_.sum(), tp_.sum()
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            jaccard = tp_ / (tp_ + fp_ + fn_)
+        jacc_sum = jaccard.sum()
+        test_jacc_sum = np.nan_to_num(jaccard).sum()
+        test_jacc_above_thresh = np.count_nonzero(jaccard >= 0.65)
 
         test_sensitivity = tp / (tp + fn) 
         test_specifitivity = tn / (tn + fp) 
@@ -373,8 +420,6 @@ class Trainer:
         test_jaccard_score = test_jacc_sum / len(results)
         test_precision = tp / (tp + fp)
 
-
-
         mean_jaccard_index = jacc_sum / len(results)
         print('---------------TEST METRICS----------------------')
         print('jaccard_index', mean_jaccard_index)
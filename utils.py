@@ -1,22 +1,37 @@
-from typing import Any, Tuple
+from typing import Any, Callable, Tuple
 import numpy as np
+import cv2
 import tensorflow as tf
-from sklearn.metrics import roc_auc_score
 from preprocessing.preprocessor import Preprocessor
+from preprocessing import preprocessing_opencv as prep
 from PIL import Image
 from tensorflow.keras.preprocessing.image import ImageDataGenerator 
 import matplotlib.pyplot as plt
 
 #PREPROCESSING
 def normalize(images, masks):
-    images = images / 255
-    masks = (masks > 0).astype(float)
+    '''Scale images to 0-1 and binarize masks as float32. Float images are scaled in place.'''
+    if images.dtype == np.uint8:
+        images = apply_lut(images, np.arange(256, dtype=np.float32) / 255)
+    else:
+        images = np.asarray(images, dtype=np.float32)
+        np.multiply(images, np.float32(1 / 255), out=images)
+    masks = (masks > 0).astype(np.float32)
     return images, masks
 
 def norm_per_channel(images, mean=None) -> Tuple[Any, float]:
+    '''Subtract mean from images as float32. Float images are modified in place.'''
     if mean is None:
         mean = images.mean()
-    return images - mean, mean
+    if images.dtype == np.uint8:
+        return apply_lut(images, np.arange(256, dtype=np.float32) - np.float32(mean)), mean
+    images = np.asarray(images, dtype=np.float32)
+    np.subtract(images, np.float32(mean), out=images)
+    return images, mean
+
+def apply_lut(images, lut) -> Any:
+    '''Map uint8 batch of images through a 256-entry lookup table with cv2.LUT'''
+    return cv2.LUT(images.reshape(len(images), -1), lut).reshape(images.shape)
 
 def apply_gaussian_blur(images, filter_radius=2) -> Any:
     resolution = images[0].shape[0]
@@ -27,13 +42,40 @@ def apply_gaussian_blur(images, filter_radius=2) -> Any:
     return images
 
 def apply_histogram_equalization(images, cutoff_percentage) -> Any:
-    resolution = images[0].shape[0]
+    '''Enchance contrast by cut off highest & lowest cutoff_percentage % of each image histogram (same as PIL ImageOps.autocontrast).\n
+    uint8 images are mapped through per image lookup tables, other types fall back to PIL.'''
+    if images.dtype != np.uint8:
+        resolution = images[0].shape[0]
+        for i, im in enumerate(images):
+            p = Preprocessor(Image.fromarray(im.flatten().reshape((resolution,resolution))).convert(mode='L'))
+            p.hist_enchance_contrast(cutoff_percentage)
+            images[i] =  p.get_processed_np_img(normalized=False)
+        return images
+
+    hist = batch_histogram(images)
+    cut = (hist.sum(axis=1) * cutoff_percentage // 100)[:, np.newaxis]
+    lo = np.argmax(hist.cumsum(axis=1) > cut, axis=1)
+    hi = 255 - np.argmax(hist[:, ::-1].cumsum(axis=1) > cut, axis=1)
+
     for i, im in enumerate(images):
-        p = Preprocessor(Image.fromarray(im.flatten().reshape((resolution,resolution))).convert(mode='L'))
-        p.hist_enchance_contrast(cutoff_percentage)
-        images[i] =  p.get_processed_np_img(normalized=False)
+        if hi[i] <= lo[i]:
+            continue
+        scale = 255.0 / (hi[i] - lo[i])
+        lut = np.clip(np.arange(256) * scale - lo[i] * scale, 0, 255).astype(np.uint8)
+        images[i] = cv2.LUT(im, lut).reshape(im.shape)
     return images
 
+def fit_zca(images, epsilon=1e-6) -> Tuple[np.ndarray, np.ndarray]:
+    '''Fit featurewise centered ZCA whitening, same as ImageDataGenerator(featurewise_center=True, zca_whitening=True).\n
+    Return: `mean, components`, whitening is `(images - mean).reshape(N, -1) @ components`'''
+    images = np.asarray(images, dtype=np.float32)
+    mean = images.mean(axis=(0, 1, 2))
+    flat = (images - mean).reshape(len(images), -1)
+
+    u, s, _ = np.linalg.svd(flat.T / np.sqrt(len(flat)), full_matrices=False)
+    s_inv = 1. / np.sqrt(s[np.newaxis]**2 + epsilon)
+    return mean, (u * s_inv).dot(u.T)
+
 def apply_zca_normalization(images, fit_dataset=None) -> Any:
     gen = ImageDataGenerator(zca_whitening=True)
 
@@ -47,7 +89,75 @@ def apply_zca_normalization(images, fit_dataset=None) -> Any:
 
     return images
 
+def add_connected_components(images, take=5) -> Any:
+    '''Add connected components masks of each image as new channels'''
+    components = [np.moveaxis(prep.connected_components(im, take=take), 0, -1) for im in np.array(images, dtype='uint8')]
+    return np.concatenate((images, np.array(components)), axis=-1).astype('f')
+
+def dataset_from_arrays(images, masks) -> tf.data.Dataset:
+    '''Create (image, mask) dataset which reads samples from (memory-mapped) arrays on demand, 
+    so the arrays are never copied into memory as a whole.'''
+    def read(i):
+        return np.array(images[i]), np.array(masks[i])
+
+    def map_fn(i):
+        image, mask = tf.numpy_function(read, [i], [tf.as_dtype(images.dtype), tf.as_dtype(masks.dtype)])
+        image.set_shape(images.shape[1:])
+        mask.set_shape(masks.shape[1:])
+        return image, mask
+
+    return tf.data.Dataset.range(len(images)).map(map_fn, num_parallel_calls=tf.data.AUTOTUNE)
+
+def numpy_map(function, image_dtype=None, mask_dtype=None, image_shape=None) -> Callable:
+    '''Wrap numpy function operating on batches of images and masks into tf.data map function operating on single samples.\n
+    Return: `map_fn(image, mask)`'''
+    def map_fn(image, mask):
+        out_image_dtype = image_dtype or image.dtype
+        out_mask_dtype = mask_dtype or mask.dtype
+
+        def apply(im, m):
+            images, masks = function(np.array(im[np.newaxis]), np.array(m[np.newaxis]))
+            return np.asarray(images[0], dtype=out_image_dtype.as_numpy_dtype), np.asarray(masks[0], dtype=out_mask_dtype.as_numpy_dtype)
+
+        out_image, out_mask = tf.numpy_function(apply, [image, mask], [out_image_dtype, out_mask_dtype])
+        out_image.set_shape(image.shape if image_shape is None else image_shape)
+        out_mask.set_shape(mask.shape)
+        return out_image, out_mask
+
+    return map_fn
+
 #FUNCTIONS
+def batch_histogram(images) -> np.ndarray:
+    '''Compute 256-bin histogram of every uint8 image in a batch with a single bincount.\n
+    Return: `histograms` of shape (N, 256)'''
+    flat = images.reshape(len(images), -1).astype(np.int64)
+    offsets = np.arange(len(flat))[:, np.newaxis] * 256
+    return np.bincount((flat + offsets).ravel(), minlength=256 * len(flat)).reshape(-1, 256)
+
+@tf.function
+def otsu_binarize(predictions):
+    '''Binarize batch of predictions (0-1) with Otsu threshold of each image, computed on device.\n
+    Same as `predictions*255` casted to uint8 and thresholded with cv2.THRESH_OTSU.\n
+    Return: `masks` of the same shape with 0/1 uint8 values'''
+    quantized = tf.cast(tf.cast(predictions, tf.float32) * 255, tf.int32)
+    flat = tf.reshape(quantized, (tf.shape(quantized)[0], -1))
+
+    #Histograms of all images are counted with a single bincount, each image gets its own range of 256 bins
+    n = tf.shape(flat)[0]
+    offsets = tf.range(n)[:, tf.newaxis] * 256
+    hist = tf.reshape(tf.math.bincount(flat + offsets, minlength=n * 256, maxlength=n * 256), (n, 256))
+    p = tf.cast(hist, tf.float64) / tf.cast(tf.shape(flat)[1], tf.float64)
+    w0 = tf.cumsum(p, axis=1)
+    mu = tf.cumsum(p * tf.range(256, dtype=tf.float64), axis=1)
+    mu_t = mu[:, -1:]
+
+    eps = np.finfo(np.float32).eps
+    valid = (w0 > eps) & (w0 < 1 - eps)
+    variance = tf.where(valid, tf.math.divide_no_nan((mu_t * w0 - mu)**2, w0 * (1 - w0)), tf.zeros_like(w0))
+    threshold = tf.argmax(variance, axis=1, output_type=tf.int32)
+
+    return tf.reshape(tf.cast(flat > threshold[:, tf.newaxis], tf.uint8), tf.shape(predictions))
+
 def iou(y_true, y_pred):
     y_pred = tf.cast(y_pred > 0.5, tf.bool)
     y_true = tf.cast(y_true, tf.bool)
@@ -57,6 +167,7 @@ def iou(y_true, y_pred):
     return iou_score
 
 def auroc(y_true, y_pred):
+    from sklearn.metrics import roc_auc_score
     return tf.py_function(roc_auc_score, (y_true, y_pred), tf.double)
 
 def jaccard_index(y_true, y_pred, smooth=0.0001):